@@ -0,0 +1,333 @@
+"""
+MIT License
+
+Copyright (c) 2023 BlvckBytes
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+
+from collections import deque
+from threading import Thread, Condition
+from logger import logln, logln_error
+
+# Priority classes, lower values are dispatched first
+PRIORITY_ADMIN = 0
+PRIORITY_AUTOMATION = 1
+PRIORITY_BOT = 2
+
+PRIORITY_NAMES = {
+  PRIORITY_ADMIN: 'admin',
+  PRIORITY_AUTOMATION: 'automation',
+  PRIORITY_BOT: 'bot',
+}
+
+# Token-bucket parameters per priority class as (commands per second, burst size), None means unlimited
+DEFAULT_RATE_LIMITS = {
+  PRIORITY_ADMIN: None,
+  PRIORITY_AUTOMATION: (10, 20),
+  PRIORITY_BOT: (2, 5),
+}
+
+# Token-bucket parameters shared by all clients of a priority class, so that floods spread across many
+# connections are throttled as well, None means unlimited
+DEFAULT_CLASS_RATE_LIMITS = {
+  PRIORITY_ADMIN: None,
+  PRIORITY_AUTOMATION: (20, 40),
+  PRIORITY_BOT: (5, 10),
+}
+
+# Commands which yield the same result no matter how often they're executed back to back
+IDEMPOTENT_COMMANDS = {
+  'save-all',
+  'save-all flush',
+  'list',
+  'tps',
+}
+
+class TokenBucket:
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last_refill = time.monotonic()
+
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+    self.last_refill = now
+
+  def has_token(self, now):
+    self.refill(now)
+    return self.tokens >= 1
+
+  def take(self):
+    self.tokens -= 1
+
+  def seconds_until_token(self, now):
+    self.refill(now)
+    return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class ClientQueue:
+
+  def __init__(self, client_id, priority, bucket):
+    self.client_id = client_id
+    self.priority = priority
+    self.bucket = bucket
+    self.commands = deque()
+    self.fragment = ''
+    self.disconnected = False
+
+class CommandScheduler:
+  """
+  Single dispatch stage in front of the server's STDIN. Commands are queued per client, dispatched
+  in order of their client's priority class, throttled by per-client as well as per-class token-buckets
+  and coalesced if an identical idempotent command is still waiting to be written.
+  """
+
+  def __init__(self, write, rate_limits=DEFAULT_RATE_LIMITS, class_rate_limits=DEFAULT_CLASS_RATE_LIMITS, max_queue_depth=64, metrics_interval=30):
+    """
+    :param write: Callable which receives a single command line (including it's newline) to write to STDIN
+    :param dict rate_limits: Mapping of priority class to (commands per second, burst size) or None per client
+    :param dict class_rate_limits: Mapping of priority class to (commands per second, burst size) or None,
+                                   shared by all clients of that class
+    :param int max_queue_depth: Maximum number of waiting commands per client, further commands are dropped
+    :param int metrics_interval: Seconds between logging metrics while there's any activity, None to disable
+    """
+
+    self.write = write
+    self.rate_limits = rate_limits
+    self.max_queue_depth = max_queue_depth
+    self.metrics_interval = metrics_interval
+    self.active = False
+    self.condition = Condition()
+    self.clients = {}
+    self.class_buckets = {
+      priority: TokenBucket(*rate_limit)
+      for priority, rate_limit in class_rate_limits.items()
+      if rate_limit is not None
+    }
+    self.dispatched = 0
+    self.coalesced = 0
+    self.dropped = 0
+
+  def register_client(self, client_id, priority):
+    """
+    Registers a client under a priority class, re-registering an existing client updates it's class
+    """
+
+    with self.condition:
+      rate_limit = self.rate_limits.get(priority)
+      bucket = None if rate_limit is None else TokenBucket(*rate_limit)
+      existing = self.clients.get(client_id)
+
+      if existing is not None:
+        existing.priority = priority
+        existing.bucket = bucket
+        existing.disconnected = False
+        return
+
+      self.clients[client_id] = ClientQueue(client_id, priority, bucket)
+
+  def unregister_client(self, client_id):
+    """
+    Marks a client as disconnected. Commands it already sent are still dispatched, subject to it's
+    buckets, and the client is forgotten as soon as it's queue has been drained. A trailing line
+    without a newline is considered complete, as nothing is going to follow it anymore.
+    """
+
+    with self.condition:
+      client = self.clients.get(client_id)
+
+      if client is None:
+        return
+
+      fragment = client.fragment
+      client.fragment = ''
+
+      if len(fragment.strip()) > 0:
+        self.enqueue(client, fragment.strip())
+
+      client.disconnected = True
+
+      if len(client.commands) == 0:
+        del self.clients[client_id]
+      else:
+        self.condition.notify()
+
+  def find_pending(self, command, priority):
+    for client in self.clients.values():
+      if client.priority <= priority and command in client.commands:
+        return True
+    return False
+
+  def enqueue(self, client, command):
+    if command in IDEMPOTENT_COMMANDS and self.find_pending(command, client.priority):
+      self.coalesced += 1
+      return False
+
+    if len(client.commands) >= self.max_queue_depth:
+      self.dropped += 1
+      return False
+
+    client.commands.append(command)
+    return True
+
+  def submit(self, client_id, message):
+    """
+    Splits a received message into command lines and queues them for the given client. Incomplete
+    trailing lines are kept back until the rest of them arrives.
+
+    :return: Number of queued command lines
+    """
+
+    queued = 0
+
+    with self.condition:
+      client = self.clients.get(client_id)
+
+      if client is None:
+        logln_error(f'Dropping message from unregistered client {client_id}')
+        return 0
+
+      lines = (client.fragment + message).split('\n')
+      client.fragment = lines.pop()
+
+      for line in lines:
+        command = line.strip()
+
+        if len(command) > 0 and self.enqueue(client, command):
+          queued += 1
+
+      if queued > 0:
+        self.condition.notify()
+
+    return queued
+
+  def next_command(self, now):
+    """
+    Pops the next command to be dispatched, if any client is allowed to send one right now
+
+    :return: Tuple of (command or None, seconds to wait before the next attempt or None if idle)
+    """
+
+    wait_time = None
+
+    for client in sorted(self.clients.values(), key=lambda c: c.priority):
+      if len(client.commands) == 0:
+        continue
+
+      class_bucket = self.class_buckets.get(client.priority)
+      buckets = [bucket for bucket in (client.bucket, class_bucket) if bucket is not None]
+      waiting_buckets = [bucket for bucket in buckets if not bucket.has_token(now)]
+
+      if len(waiting_buckets) == 0:
+        for bucket in buckets:
+          bucket.take()
+
+        command = client.commands.popleft()
+
+        # Rotate the client to the end, so that clients of the same class are served round-robin,
+        # disconnected clients are forgotten once there's nothing left to dispatch for them
+        del self.clients[client.client_id]
+
+        if not client.disconnected or len(client.commands) > 0:
+          self.clients[client.client_id] = client
+
+        return (command, None)
+
+      client_wait = max(bucket.seconds_until_token(now) for bucket in waiting_buckets)
+      wait_time = client_wait if wait_time is None else min(wait_time, client_wait)
+
+    return (None, wait_time)
+
+  def log_metrics_if_due(self, now):
+    if self.metrics_interval is None or now < self.next_metrics_log:
+      return
+
+    self.next_metrics_log = now + self.metrics_interval
+    metrics = self.metrics()
+
+    # Stay quiet while idle, so that the log is not flooded with identical lines
+    if metrics == self.last_logged_metrics:
+      return
+
+    self.last_logged_metrics = metrics
+    logln(f'Command scheduler metrics: {metrics}')
+
+  def dispatch_loop(self):
+    self.next_metrics_log = time.monotonic()
+    self.last_logged_metrics = None
+
+    while self.active:
+      with self.condition:
+        now = time.monotonic()
+        self.log_metrics_if_due(now)
+        command, wait_time = self.next_command(now)
+
+        if command is None:
+          if self.metrics_interval is not None:
+            metrics_wait = max(0, self.next_metrics_log - now)
+            wait_time = metrics_wait if wait_time is None else min(wait_time, metrics_wait)
+
+          self.condition.wait(wait_time)
+          continue
+
+        self.dispatched += 1
+
+      try:
+        self.write(f'{command}\n')
+      except (BrokenPipeError, ValueError) as e:
+        logln_error(f'Could not dispatch command {command}: {e}')
+        self.stop()
+
+  def metrics(self):
+    """
+    Get a snapshot of the scheduler's counters as well as the current queue depth per priority class
+
+    :return: Dictionary of metric names to values
+    """
+
+    with self.condition:
+      depths = {name: 0 for name in PRIORITY_NAMES.values()}
+
+      for client in self.clients.values():
+        depths[PRIORITY_NAMES[client.priority]] += len(client.commands)
+
+      return {
+        'queue_depth': depths,
+        'clients': len(self.clients),
+        'dispatched': self.dispatched,
+        'coalesced': self.coalesced,
+        'dropped': self.dropped,
+      }
+
+  def start(self):
+    self.active = True
+    t = Thread(target=self.dispatch_loop, name='cmd_sched')
+    t.daemon = True
+    t.start()
+
+  def stop(self):
+    logln('Disabling command scheduler')
+
+    with self.condition:
+      self.active = False
+      self.condition.notify_all()
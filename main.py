@@ -24,16 +24,47 @@ SOFTWARE.
 
 import sys
 import time
+import argparse
 
 from socket_terminal import socket_terminal
-from logger import logln_error
+from setup_java import SERVER_MODULES
+
+
+def parse_modules(value):
+  return tuple(module.strip() for module in value.split(',') if len(module.strip()) > 0)
+
+def positive_int(value):
+  number = int(value)
+
+  if number <= 0:
+    raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+
+  return number
 
 def main():
-  if len(sys.argv) != 3:
-    logln_error(f'Usage: {sys.argv[0]} <rev> <socket_port>')
-    sys.exit(1)
+  parser = argparse.ArgumentParser()
+  parser.add_argument('rev', help='Revision of the minecraft server (1.8, 1.9, 1.17, ...)')
+  parser.add_argument('socket_port', type=int, help='Port for admin clients, which are never rate-limited')
+  parser.add_argument('backup_interval', type=positive_int, nargs='?', default=None, help='Seconds between two world backups')
+  parser.add_argument('--jlink', action='store_true', help='Run the server on a trimmed runtime (JDK 11+)')
+  parser.add_argument('--jlink-modules', type=parse_modules, default=(), help='Comma separated modules to add to the trimmed runtime, e.g. jdk.httpserver,jdk.charsets')
+  parser.add_argument('--automation-port', type=int, default=None, help='Port for automation clients')
+  parser.add_argument('--bot-port', type=int, default=None, help='Port for bot clients, which are dispatched last')
+  parser.add_argument('--max-clients-per-host', type=int, default=None, help='Connection limit per host on the automation and bot ports')
+  args = parser.parse_args()
+
+  if len(args.jlink_modules) > 0 and not args.jlink:
+    parser.error('--jlink-modules requires --jlink')
 
-  server = socket_terminal(sys.argv[1], int(sys.argv[2]))
+  server = socket_terminal(
+    args.rev, args.socket_port,
+    automation_port=args.automation_port,
+    bot_port=args.bot_port,
+    max_clients_per_host=args.max_clients_per_host,
+    backup_interval=args.backup_interval,
+    trimmed_runtime=args.jlink,
+    runtime_modules=tuple(sorted(set(SERVER_MODULES + args.jlink_modules)))
+  )
 
   if server is None:
     sys.exit(1)
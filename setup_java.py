@@ -27,11 +27,37 @@ import glob
 import platform
 import requests
 import os
+import shutil
 import tarfile
+import hashlib
+import tempfile
 
 from tqdm import tqdm
 from logger import logln, logln_error
-from bash_utils import run_bash
+from bash_utils import run_bash_live
+
+# Modules which the server and commonly used plugins require at runtime, BuildTools still runs on
+# the full JDK, as it needs the compiler and it's tooling
+SERVER_MODULES = (
+  'java.base',
+  'java.compiler',
+  'java.desktop',
+  'java.instrument',
+  'java.logging',
+  'java.management',
+  'java.naming',
+  'java.net.http',
+  'java.prefs',
+  'java.rmi',
+  'java.scripting',
+  'java.security.jgss',
+  'java.sql',
+  'java.xml',
+  'jdk.crypto.ec',
+  'jdk.management',
+  'jdk.unsupported',
+  'jdk.zipfs',
+)
 
 def get_jdk_url(version, arch):
   """
@@ -92,16 +118,88 @@ def decide_system_architecture():
   logln_error(f'Unsupported system architecture: {machine}')
   return None
 
-def setup_java(version):
+def get_runtime_path(jdk_path, modules):
   """
-  Setup the provided java version as the default JVM
+  Get the absolute path a trimmed runtime of a specific JDK and module set is cached at
 
-  :return: True on success, False on failure
+  :param str jdk_path: Path of the JDK the runtime is linked from
+  :param modules: Modules contained within the runtime
+  :return: Runtime path, which may not yet exist
+  """
+
+  modules_hash = hashlib.sha256(','.join(sorted(modules)).encode('utf-8')).hexdigest()[:12]
+  return f'/usr/lib/jvm/runtime-{os.path.basename(jdk_path)}-{modules_hash}'
+
+def setup_runtime(version, jdk_path, modules):
+  """
+  Links a minimal runtime containing only the provided modules out of a downloaded JDK, if it
+  has not already been linked before
+
+  :param int version: Java major version of the JDK
+  :param str jdk_path: Path of the JDK to link the runtime from
+  :param modules: Modules to include into the runtime
+  :return: Runtime path on success, None on failure
+  """
+
+  runtime_path = get_runtime_path(jdk_path, modules)
+
+  if os.path.isfile(os.path.join(runtime_path, 'bin/java')):
+    return runtime_path
+
+  jlink_path = os.path.join(jdk_path, 'bin/jlink')
+
+  if not os.path.isfile(jlink_path):
+    logln_error(f'Could not find jlink at {jlink_path}')
+    return None
+
+  logln(f'Linking trimmed runtime for JDK {version} into {runtime_path}')
+
+  # Link into a temporary directory of this process first, so that neither an interrupted jlink nor
+  # another instance linking the same runtime concurrently can leave a broken runtime behind
+  temp_dir = tempfile.mkdtemp(prefix='.runtime-', dir='/usr/lib/jvm')
+  temp_path = os.path.join(temp_dir, 'runtime')
+
+  exit_code = run_bash_live(
+    f'{jlink_path} --add-modules {",".join(sorted(modules))} '
+    f'--strip-debug --no-man-pages --no-header-files --output {temp_path}'
+  )
+
+  if exit_code != 0:
+    logln_error(f'jlink yielded invalid exit-code {exit_code}')
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return None
+
+  # Starting with JDK 12, the default class data sharing archive can be generated, which speeds up JVM startup
+  if version >= 12 and run_bash_live(f'{os.path.join(temp_path, "bin/java")} -Xshare:dump') != 0:
+    logln_error(f'Could not generate the class data sharing archive for JDK {version}, continuing without')
+
+  try:
+    os.rename(temp_path, runtime_path)
+  except OSError as e:
+    # Another instance may have finished linking the very same runtime in the meantime
+    if not os.path.isfile(os.path.join(runtime_path, 'bin/java')):
+      logln_error(f'Could not move the trimmed runtime into {runtime_path}: {e}')
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      return None
+
+  shutil.rmtree(temp_dir, ignore_errors=True)
+  return runtime_path
+
+def setup_java(version, trimmed_runtime=False, modules=SERVER_MODULES):
+  """
+  Setup the provided java version by downloading it's JDK if it's not yet on the system and
+  optionally linking a trimmed runtime out of it. Multiple versions may be in use at the same
+  time, as the binaries are always referred to by their absolute paths.
+
+  :param int version: Java major version to set up
+  :param bool trimmed_runtime: Whether to respond with a trimmed runtime, only supported from JDK 11 on
+  :param modules: Modules to include into the trimmed runtime
+  :return: Tuple of (JDK java binary path, server java binary path) on success, None on failure
   """
 
   arch = decide_system_architecture()
   if arch is None:
-    return False
+    return None
 
   jdk_path = get_jdk_path(version)
 
@@ -110,7 +208,7 @@ def setup_java(version):
     jdk_url = get_jdk_url(version, arch)
 
     if jdk_url is None:
-      return False
+      return None
 
     with requests.get(jdk_url, stream=True) as rx:
       # check header to get content length, in bytes
@@ -131,16 +229,22 @@ def setup_java(version):
 
   if jdk_path is None:
     logln_error(f'Could not find JDK {version} on the system')
-    return False
+    return None
+
+  jdk_java = os.path.join(jdk_path, 'bin/java')
+
+  if not trimmed_runtime:
+    return (jdk_java, jdk_java)
 
-  logln(f'Setting JDK {version} as a default')
+  # JDK 8 predates the module system, so there's nothing to link
+  if version < 11:
+    logln(f'Trimmed runtimes are not supported for JDK {version}, using the full JDK')
+    return (jdk_java, jdk_java)
 
-  # Update the link to the java binary
-  run_bash('rm -f /usr/bin/java')
-  cout, cerr = run_bash(f'ln -s {os.path.join(jdk_path, "bin/java")} /usr/bin/java')
+  runtime_path = setup_runtime(version, jdk_path, modules)
 
-  if len(cerr) != 0:
-    logln_error(f'Could not link JDK {version} as a default!')
-    return False
+  if runtime_path is None:
+    logln_error(f'Could not link a trimmed runtime for JDK {version}')
+    return None
 
-  return True
\ No newline at end of file
+  return (jdk_java, os.path.join(runtime_path, 'bin/java'))
\ No newline at end of file
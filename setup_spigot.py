@@ -29,15 +29,16 @@ from tqdm import tqdm
 from bash_utils import run_bash_live
 from tqdm_wrapper import tqdm_wrapper
 from logger import logln, logln_error
-from setup_java import setup_java
+from setup_java import setup_java, SERVER_MODULES
 
-def build_spigot(rev, output_dir):
+def build_spigot(rev, output_dir, java_binary):
   """
   Downloads the BuildTools JAR file into a temporary directory and invokes it by passing
   the desired revision as well as the output directory path as arguments
 
   :param str rev: Revision of the minecraft server (1.8, 1.9, 1.17, ...)
   :param str output_dir: Output directory to put the final JAR file into
+  :param str java_binary: Path of the JDK's java binary to run BuildTools with
   :return: Final JAR path on success, None on errors
   """
 
@@ -65,7 +66,7 @@ def build_spigot(rev, output_dir):
 
     logln('BuildTools download finished')
 
-  exit_code = run_bash_live(f'java -jar BuildTools.jar --rev {rev} --output-dir={output_dir}', container_dir)
+  exit_code = run_bash_live(f'{java_binary} -jar BuildTools.jar --rev {rev} --output-dir={output_dir}', container_dir)
 
   if exit_code != 0:
     logln_error(f'BuildTools yielded invalid exit-code {exit_code}')
@@ -128,11 +129,13 @@ def delete_world_locks(server_dir):
 
   run_bash_live('rm -f world*/session.lock', server_dir)
 
-def setup_spigot(rev):
+def setup_spigot(rev, trimmed_runtime=False, runtime_modules=SERVER_MODULES):
   """
   Installs the required java version, builds the required spigot JAR file and finally accepts the EULA
 
-  :return: Server JAR file path on success, None on errors
+  :param bool trimmed_runtime: Whether to run the server on a trimmed runtime instead of the full JDK
+  :param runtime_modules: Modules to include into the trimmed runtime
+  :return: Tuple of (server JAR file path, java binary path to run it with) on success, None on errors
   """
 
   java_version = decide_java_version(rev)
@@ -146,11 +149,14 @@ def setup_spigot(rev):
   if not os.path.isdir(server_dir):
     os.makedirs(server_dir)
 
-  if not setup_java(java_version):
+  java_binaries = setup_java(java_version, trimmed_runtime, runtime_modules)
+
+  if java_binaries is None:
     logln_error(f'Could not set up the required java version, exiting')
     return None
 
-  jar_path = build_spigot(rev, server_dir)
+  jdk_java, server_java = java_binaries
+  jar_path = build_spigot(rev, server_dir, jdk_java)
 
   if jar_path is None:
     logln_error(f'Could not build the required spigot jar for minecraft-revision {rev}, exiting')
@@ -158,4 +164,4 @@ def setup_spigot(rev):
 
   accept_eula(server_dir)
   delete_world_locks(server_dir)
-  return jar_path
\ No newline at end of file
+  return (jar_path, server_java)
\ No newline at end of file
@@ -22,37 +22,72 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import codecs
 import socket
 
-from threading import Thread
+from threading import Thread, Lock
 from logger import logln
 
 class SocketServer:
 
-  def __init__(self, ip, port):
+  def __init__(self, ip, port, max_clients_per_host=None):
     self.ip = ip
     self.port = port
+    self.max_clients_per_host = max_clients_per_host
+    self.host_connections = {}
+    self.host_connections_lock = Lock()
     self.active = False
     self.receivers = []
+    self.connect_listeners = []
+    self.disconnect_listeners = []
     self.clients = []
 
   def setup_client(self, client: socket.socket, addr):
     self.clients.append(client)
 
-    while self.active:
-      data = client.recv(4096)
+    # Multi-byte characters may be split across two reads, so decode incrementally
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
 
-      if not data:
-        break
+    try:
+      for listener in self.connect_listeners:
+        listener(addr)
 
-      message = data.decode('utf-8')
-      logln(f'Received from {addr} for port {self.port}: {message}')
+      while self.active:
+        data = client.recv(4096)
+
+        if not data:
+          break
+
+        message = decoder.decode(data)
+        logln(f'Received from {addr} for port {self.port}: {message}')
+
+        for receiver in self.receivers:
+          receiver(message, addr)
+    except OSError as e:
+      logln(f'Lost socket client at {addr} for port {self.port}: {e}')
+    finally:
+      self.clients.remove(client)
+
+      for listener in self.disconnect_listeners:
+        listener(addr)
+
+      client.close()
 
-      for receiver in self.receivers:
-        receiver(message)
+      with self.host_connections_lock:
+        self.host_connections[addr[0]] -= 1
 
-    self.clients.remove(client)
-    client.close()
+        if self.host_connections[addr[0]] == 0:
+          del self.host_connections[addr[0]]
+
+  def try_reserve_connection(self, host):
+    with self.host_connections_lock:
+      connections = self.host_connections.get(host, 0)
+
+      if self.max_clients_per_host is not None and connections >= self.max_clients_per_host:
+        return False
+
+      self.host_connections[host] = connections + 1
+      return True
 
   def setup_socket(self):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -64,6 +99,11 @@ class SocketServer:
       while self.active:
         client, addr = s.accept()
 
+        if not self.try_reserve_connection(addr[0]):
+          logln(f'Rejected socket client at {addr} for port {self.port}, too many connections from {addr[0]}')
+          client.close()
+          continue
+
         t = Thread(target=self.setup_client, args=(client, addr), name=f'cl_l:{addr}')
         t.daemon = True
         t.start()
@@ -87,4 +127,10 @@ class SocketServer:
       client.send(message.encode('utf-8'))
 
   def onAnyReceive(self, receiver):
-    self.receivers.append(receiver)
\ No newline at end of file
+    self.receivers.append(receiver)
+
+  def onAnyConnect(self, listener):
+    self.connect_listeners.append(listener)
+
+  def onAnyDisconnect(self, listener):
+    self.disconnect_listeners.append(listener)
\ No newline at end of file
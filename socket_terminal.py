@@ -26,11 +26,14 @@ import subprocess
 import os
 
 from socket_server import SocketServer
+from world_backup import WorldBackup
+from command_scheduler import CommandScheduler, PRIORITY_ADMIN, PRIORITY_AUTOMATION, PRIORITY_BOT, PRIORITY_NAMES
 from setup_spigot import setup_spigot
+from setup_java import SERVER_MODULES
 from logger import logln_error, logln
 from threading import Thread
 
-def process_listener(process: subprocess.Popen, server: SocketServer):
+def process_listener(process: subprocess.Popen, servers, output_listeners):
   while process.returncode is None:
     line = process.stdout.readline()
 
@@ -39,42 +42,100 @@ def process_listener(process: subprocess.Popen, server: SocketServer):
 
     message = line.decode('utf-8')
     logln(f'Received from STDOUT: {message.strip()}')
-    server.sendToAll(message)
 
-  server.stop()
+    for server in servers:
+      server.sendToAll(message)
+
+    for listener in output_listeners:
+      listener(message)
+
+  for server in servers:
+    server.stop()
+
+def register_socket_client(client_id, priority, scheduler: CommandScheduler):
+  scheduler.register_client(client_id, priority)
+  logln(f'Registered socket client {client_id} as {PRIORITY_NAMES[priority]}')
+
+def unregister_socket_client(client_id, scheduler: CommandScheduler):
+  scheduler.unregister_client(client_id)
+  logln(f'Unregistered socket client {client_id}, scheduler metrics: {scheduler.metrics()}')
+
+def setup_class_server(port, priority, scheduler: CommandScheduler, max_clients_per_host):
+  """
+  Sets up a socket server whose clients all belong to the provided priority class. Clients are told
+  apart by the port they connect to rather than by their host, as all of them may share the same
+  host when connecting through a container's bridge.
+
+  :return: Started SocketServer instance
+  """
+
+  server = SocketServer('0.0.0.0', port, max_clients_per_host)
+  server.onAnyConnect(lambda addr: register_socket_client((port, addr), priority, scheduler))
+  server.onAnyDisconnect(lambda addr: unregister_socket_client((port, addr), scheduler))
+  server.onAnyReceive(lambda message, addr: scheduler.submit((port, addr), message))
+  server.start()
+  return server
 
 def relay_socket_message(message, process: subprocess.Popen):
   process.stdin.write(message.encode('utf-8'))
   process.stdin.flush()
-  logln(f'Wrote to STDIN: {message}')
+  logln(f'Wrote to STDIN: {message.strip()}')
 
-def socket_terminal(rev, port):
+def socket_terminal(rev, port, automation_port=None, bot_port=None, max_clients_per_host=None, backup_interval=None, trimmed_runtime=False, runtime_modules=SERVER_MODULES):
   """
   Sets up the provided minecraft-revision of spigot and spawns the process in a terminal
-  which communicates over a socket connection
-
-  :return: SocketServer instance on success, None on failure
+  which communicates over socket connections. Commands of all clients pass through a single
+  scheduler, which prioritizes them by the port they connected to and rate-limits them per client and class.
+
+  :param int port: Port for admin clients, which are dispatched first and never rate-limited
+  :param int automation_port: Port for automation clients, None to not accept any
+  :param int bot_port: Port for bot clients, which are dispatched last, None to not accept any
+  :param int max_clients_per_host: Connection limit per host on the automation and bot ports, None for no limit
+  :param int backup_interval: Seconds between two incremental world backups, None to disable backups
+  :param bool trimmed_runtime: Whether to run the server on a jlink'd runtime instead of the full JDK
+  :param runtime_modules: Modules to include into the trimmed runtime
+  :return: Admin SocketServer instance on success, None on failure
   """
 
-  jar_path = setup_spigot(rev)
+  setup_result = setup_spigot(rev, trimmed_runtime, runtime_modules)
 
-  if jar_path is None:
+  if setup_result is None:
     logln_error(f'Could not set up spigot for minecraft-revision {rev}, exiting')
     return None
 
+  jar_path, java_binary = setup_result
+
   process = subprocess.Popen(
-    f'java -jar {os.path.basename(jar_path)} nogui'.split(),
+    f'{java_binary} -jar {os.path.basename(jar_path)} nogui'.split(),
     stdin=subprocess.PIPE,
     stdout=subprocess.PIPE,
     stderr=subprocess.STDOUT,
     cwd=os.path.dirname(jar_path)
   )
 
-  server = SocketServer('0.0.0.0', port)
-  server.start()
-  server.onAnyReceive(lambda message: relay_socket_message(message, process))
+  scheduler = CommandScheduler(lambda message: relay_socket_message(message, process))
+  scheduler.start()
+
+  server = setup_class_server(port, PRIORITY_ADMIN, scheduler, None)
+  servers = [server]
+
+  if automation_port is not None:
+    servers.append(setup_class_server(automation_port, PRIORITY_AUTOMATION, scheduler, max_clients_per_host))
+
+  if bot_port is not None:
+    servers.append(setup_class_server(bot_port, PRIORITY_BOT, scheduler, max_clients_per_host))
+
+  output_listeners = []
+
+  if backup_interval is not None:
+    server_dir = os.path.dirname(jar_path)
+    store_dir = os.path.join(os.path.expanduser('~'), 'backups', os.path.basename(server_dir))
+
+    backup = WorldBackup(server_dir, store_dir, scheduler)
+    output_listeners.append(backup.on_server_output)
+    backup.start(backup_interval)
 
-  t = Thread(target=process_listener, args=(process, server), name=f'proc_l:{rev}')
+  t = Thread(target=process_listener, args=(process, servers, output_listeners), name=f'proc_l:{rev}')
 
   t.daemon = True
   t.start()
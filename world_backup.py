@@ -0,0 +1,470 @@
+"""
+MIT License
+
+Copyright (c) 2023 BlvckBytes
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import re
+import sys
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import fcntl
+
+from threading import Thread, Event
+from logger import logln, logln_error
+from command_scheduler import CommandScheduler, PRIORITY_ADMIN
+
+# Region files are made up of 4KiB sectors, so chunk boundaries stay aligned with them
+CHUNK_SIZE = 16 * 4096
+
+# Server output lines which acknowledge a save-off and signal a completed save-all (newer and older revisions).
+# They are anchored to the server's own log prefix, so that players cannot forge them through chat.
+SAVE_OFF_PATTERN = re.compile(r'^\[[^\]]*INFO\]: (Automatic saving is now disabled|Turned off world auto-saving)\s*$')
+SAVE_ALREADY_OFF_PATTERN = re.compile(r'^\[[^\]]*INFO\]: Saving is already turned off\s*$')
+SAVE_COMPLETED_PATTERN = re.compile(r'^\[[^\]]*INFO\]: Saved the (game|world)\s*$')
+
+# Files which are held open by the server and never make sense to restore
+EXCLUDED_FILES = ('session.lock',)
+
+SCHEDULER_CLIENT_ID = 'world_backup'
+
+def list_world_files(server_dir):
+  """
+  Lists all files within the world directories of a server
+
+  :param str server_dir: Path of the folder where the server is executed at
+  :return: List of file paths relative to the server directory
+  """
+
+  files = []
+
+  for world_dir in sorted(glob.glob(os.path.join(server_dir, 'world*'))):
+    if not os.path.isdir(world_dir):
+      continue
+
+    for root, _, names in os.walk(world_dir):
+      for name in names:
+        if name in EXCLUDED_FILES:
+          continue
+
+        files.append(os.path.relpath(os.path.join(root, name), server_dir))
+
+  return sorted(files)
+
+def get_object_path(store_dir, digest):
+  return os.path.join(store_dir, 'objects', digest[:2], digest)
+
+def get_snapshot_path(store_dir, snapshot):
+  return os.path.join(store_dir, 'snapshots', f'{snapshot}.json')
+
+def list_snapshots(store_dir):
+  """
+  Lists all snapshots within a backup store, oldest first
+
+  :param str store_dir: Path of the content-addressed backup store
+  :return: List of snapshot names
+  """
+
+  paths = glob.glob(get_snapshot_path(store_dir, '*'))
+  return sorted(os.path.splitext(os.path.basename(path))[0] for path in paths)
+
+def load_snapshot(store_dir, snapshot):
+  """
+  Loads the manifest of a snapshot
+
+  :return: Manifest dictionary on success, None if the snapshot does not exist
+  """
+
+  path = get_snapshot_path(store_dir, snapshot)
+
+  if not os.path.isfile(path):
+    return None
+
+  with open(path, 'r') as f:
+    return json.load(f)
+
+def store_file_chunks(path, store_dir, throttle):
+  """
+  Hashes a file in chunks and writes all chunks into the store which it does not yet contain
+
+  :param str path: Path of the file to store
+  :param str store_dir: Path of the content-addressed backup store
+  :param throttle: Callable which receives the number of bytes just processed, used to limit I/O
+  :return: Tuple of (list of chunk digests, number of newly written bytes)
+  """
+
+  digests = []
+  written = 0
+
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+
+      if len(chunk) == 0:
+        break
+
+      digest = hashlib.sha256(chunk).hexdigest()
+      digests.append(digest)
+      object_path = get_object_path(store_dir, digest)
+
+      if not os.path.isfile(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+        # Write to a temporary file first, so that an interrupted backup never leaves a torn object
+        temp_path = f'{object_path}.tmp'
+        with open(temp_path, 'wb') as o:
+          o.write(chunk)
+        os.replace(temp_path, object_path)
+
+        written += len(chunk)
+
+      throttle(len(chunk))
+
+  return (digests, written)
+
+def rebuild_snapshot_files(store_dir, snapshot, manifest, target_dir):
+  """
+  Writes all files of a snapshot into the target directory, verifying every chunk on the way
+
+  :return: True on success, False if an object turned out to be corrupt
+  """
+
+  for relative_path, entry in manifest['files'].items():
+    path = os.path.join(target_dir, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+      for digest in entry['chunks']:
+        with open(get_object_path(store_dir, digest), 'rb') as o:
+          chunk = o.read()
+
+        if hashlib.sha256(chunk).hexdigest() != digest:
+          logln_error(f'Snapshot {snapshot} references corrupt object {digest}, not restoring')
+          return False
+
+        f.write(chunk)
+
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+  return True
+
+def is_world_locked(server_dir):
+  """
+  Checks whether any world of a server is currently held by a running server process. Revisions
+  which lock their session.lock files (1.16 and newer) are detected reliably, older revisions
+  only write a timestamp into them.
+
+  :param str server_dir: Path of the folder where the server is executed at
+  :return: True if any world is locked, False otherwise
+  """
+
+  for lock_path in glob.glob(os.path.join(server_dir, 'world*', 'session.lock')):
+    try:
+      with open(lock_path, 'r+b') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.lockf(f, fcntl.LOCK_UN)
+    except (BlockingIOError, PermissionError):
+      return True
+    except FileNotFoundError:
+      continue
+
+  return False
+
+def restore_snapshot(store_dir, snapshot, server_dir):
+  """
+  Restores a snapshot into a server directory, replacing all of it's world directories. The server
+  must not be running while restoring, which is refused if any of it's worlds is locked.
+
+  :param str store_dir: Path of the content-addressed backup store
+  :param str snapshot: Name of the snapshot to restore
+  :param str server_dir: Path of the folder where the server is executed at
+  :return: True on success, False on failure
+  """
+
+  if is_world_locked(server_dir):
+    logln_error(f'A world in {server_dir} is locked by a running server, stop it before restoring')
+    return False
+
+  manifest = load_snapshot(store_dir, snapshot)
+
+  if manifest is None:
+    logln_error(f'Could not find snapshot {snapshot} in {store_dir}')
+    return False
+
+  for entry in manifest['files'].values():
+    for digest in entry['chunks']:
+      if not os.path.isfile(get_object_path(store_dir, digest)):
+        logln_error(f'Snapshot {snapshot} references missing object {digest}, not restoring')
+        return False
+
+  os.makedirs(server_dir, exist_ok=True)
+
+  # Rebuild next to the target first, so that the current worlds stay untouched if anything fails
+  restore_dir = tempfile.mkdtemp(prefix='.restore-', dir=server_dir)
+
+  try:
+    rebuilt = rebuild_snapshot_files(store_dir, snapshot, manifest, restore_dir)
+  except OSError as e:
+    logln_error(f'Could not rebuild snapshot {snapshot}: {e}')
+    rebuilt = False
+
+  if not rebuilt:
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    return False
+
+  # Renames within the same filesystem are cheap, so the worlds are only missing for a brief moment.
+  # Should a rename fail, both the previous and the restored worlds are left behind for manual recovery.
+  previous_dir = tempfile.mkdtemp(prefix='.previous-', dir=server_dir)
+
+  for world_dir in glob.glob(os.path.join(server_dir, 'world*')):
+    if os.path.isdir(world_dir):
+      os.rename(world_dir, os.path.join(previous_dir, os.path.basename(world_dir)))
+
+  for world_dir in glob.glob(os.path.join(restore_dir, 'world*')):
+    os.rename(world_dir, os.path.join(server_dir, os.path.basename(world_dir)))
+
+  shutil.rmtree(previous_dir)
+  shutil.rmtree(restore_dir)
+
+  logln(f'Restored snapshot {snapshot} ({len(manifest["files"])} files) into {server_dir}')
+  return True
+
+class WorldBackup:
+  """
+  Takes incremental backups of a running server's worlds. Saving is paused only for as long as it takes
+  to copy files which changed since the last snapshot into a staging directory, hashing and storing
+  their chunks happens afterwards at a limited rate.
+  """
+
+  def __init__(self, server_dir, store_dir, scheduler: CommandScheduler, max_bytes_per_second=32 * 1024 * 1024, save_timeout=120):
+    """
+    :param str server_dir: Path of the folder where the server is executed at
+    :param str store_dir: Path of the content-addressed backup store
+    :param CommandScheduler scheduler: Scheduler used to relay save commands to the server
+    :param int max_bytes_per_second: Hashing and storing I/O limit, None to disable throttling
+    :param int save_timeout: Seconds to wait for the server to complete a save-all before aborting
+    """
+
+    self.server_dir = server_dir
+    self.store_dir = store_dir
+    self.scheduler = scheduler
+    self.max_bytes_per_second = max_bytes_per_second
+    self.save_timeout = save_timeout
+    self.save_off = Event()
+    self.save_was_off = False
+    self.save_completed = Event()
+    self.active = False
+
+    self.scheduler.register_client(SCHEDULER_CLIENT_ID, PRIORITY_ADMIN)
+
+  def on_server_output(self, message):
+    """
+    Listener for lines printed by the server, used to detect completed saves
+    """
+
+    if SAVE_OFF_PATTERN.search(message):
+      self.save_was_off = False
+      self.save_off.set()
+
+    if SAVE_ALREADY_OFF_PATTERN.search(message):
+      self.save_was_off = True
+      self.save_off.set()
+
+    if SAVE_COMPLETED_PATTERN.search(message):
+      self.save_completed.set()
+
+  def make_throttle(self):
+    started = time.monotonic()
+    processed = [0]
+
+    def throttle(num_bytes):
+      if self.max_bytes_per_second is None:
+        return
+
+      processed[0] += num_bytes
+      ahead = processed[0] / self.max_bytes_per_second - (time.monotonic() - started)
+
+      if ahead > 0:
+        time.sleep(ahead)
+
+    return throttle
+
+  def stage_changed_files(self, previous_files, staging_dir):
+    """
+    Copies all world files which differ from the previous snapshot into the staging directory
+
+    :return: Tuple of (dictionary of unchanged manifest entries, dictionary of staged file stats)
+    """
+
+    unchanged = {}
+    staged = {}
+
+    for relative_path in list_world_files(self.server_dir):
+      path = os.path.join(self.server_dir, relative_path)
+
+      try:
+        stat = os.stat(path)
+      except FileNotFoundError:
+        continue
+
+      previous = previous_files.get(relative_path)
+
+      if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        unchanged[relative_path] = previous
+        continue
+
+      staged_path = os.path.join(staging_dir, relative_path)
+      os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+
+      # Files like player data are still replaced while saving is off, so they may vanish at any point
+      try:
+        shutil.copyfile(path, staged_path)
+      except FileNotFoundError:
+        continue
+
+      staged[relative_path] = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+    return (unchanged, staged)
+
+  def take_snapshot(self):
+    """
+    Takes a snapshot of the server's worlds, only storing chunks which are not yet within the store
+
+    :return: Snapshot name on success, None on failure
+    """
+
+    snapshots = list_snapshots(self.store_dir)
+    previous = load_snapshot(self.store_dir, snapshots[-1]) if len(snapshots) > 0 else None
+    previous_files = {} if previous is None else previous['files']
+
+    snapshot = time.strftime('%Y%m%d-%H%M%S')
+    staging_dir = os.path.join(self.store_dir, 'staging')
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    logln(f'Taking world snapshot {snapshot}, pausing saves')
+
+    self.save_off.clear()
+    self.save_was_off = False
+    self.scheduler.submit(SCHEDULER_CLIENT_ID, 'save-off\n')
+
+    try:
+      if not self.save_off.wait(self.save_timeout):
+        logln_error(f'Server did not acknowledge save-off within {self.save_timeout}s, aborting snapshot')
+        return None
+
+      # Saves which have been issued before the save-off have completed by now, as the server handles
+      # commands in order, so the next completed save is our own flush
+      self.save_completed.clear()
+      self.scheduler.submit(SCHEDULER_CLIENT_ID, 'save-all flush\n')
+
+      if not self.save_completed.wait(self.save_timeout):
+        logln_error(f'Server did not complete saving within {self.save_timeout}s, aborting snapshot')
+        return None
+
+      window_start = time.monotonic()
+      unchanged, staged = self.stage_changed_files(previous_files, staging_dir)
+    finally:
+      # Only turn saving back on if this snapshot turned it off, an operator may have disabled it on purpose.
+      # Without any acknowledgement, our save-off is the most likely one to eventually take effect.
+      if self.save_was_off:
+        logln('Saving had already been turned off before the snapshot, leaving it off')
+      else:
+        self.scheduler.submit(SCHEDULER_CLIENT_ID, 'save-on\n')
+
+    logln(f'Staged changed files after {time.monotonic() - window_start:.2f}s, storing {len(staged)} changed files')
+
+    files = dict(unchanged)
+    throttle = self.make_throttle()
+    written = 0
+
+    for relative_path, stat in staged.items():
+      digests, file_written = store_file_chunks(os.path.join(staging_dir, relative_path), self.store_dir, throttle)
+      files[relative_path] = { 'size': stat['size'], 'mtime_ns': stat['mtime_ns'], 'chunks': digests }
+      written += file_written
+
+    snapshot_path = get_snapshot_path(self.store_dir, snapshot)
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+
+    with open(f'{snapshot_path}.tmp', 'w') as f:
+      json.dump({ 'created': time.time(), 'files': files }, f)
+    os.replace(f'{snapshot_path}.tmp', snapshot_path)
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    logln(f'World snapshot {snapshot} finished, {len(files)} files, {written} new bytes stored')
+    return snapshot
+
+  def backup_loop(self, interval):
+    while self.active:
+      # Sleep in small steps, so that stopping does not have to wait for a whole interval
+      deadline = time.monotonic() + interval
+      while self.active and time.monotonic() < deadline:
+        time.sleep(1)
+
+      if not self.active:
+        break
+
+      # A corrupt manifest raises ValueError or KeyError, which must not end all future backups
+      try:
+        self.take_snapshot()
+      except (OSError, ValueError, KeyError) as e:
+        logln_error(f'Could not take world snapshot: {e!r}')
+
+  def start(self, interval):
+    """
+    Starts taking snapshots periodically on a background thread
+
+    :param int interval: Seconds between two snapshots
+    """
+
+    self.active = True
+    t = Thread(target=self.backup_loop, args=(interval,), name='world_backup')
+    t.daemon = True
+    t.start()
+
+  def stop(self):
+    logln('Disabling world backups')
+    self.active = False
+
+def main():
+  if len(sys.argv) == 3 and sys.argv[1] == 'list':
+    for snapshot in list_snapshots(sys.argv[2]):
+      print(snapshot)
+    return
+
+  if len(sys.argv) == 5 and sys.argv[1] == 'restore':
+    if not restore_snapshot(sys.argv[2], sys.argv[3], sys.argv[4]):
+      sys.exit(1)
+    return
+
+  logln_error(f'Usage: {sys.argv[0]} list <store_dir>')
+  logln_error(f'       {sys.argv[0]} restore <store_dir> <snapshot> <server_dir>')
+  sys.exit(1)
+
+if __name__ == '__main__':
+  main()